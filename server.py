@@ -2,21 +2,37 @@
 """Remote MCP Server for Microsoft Graph API with Amazon Bedrock support."""
 
 import os
-import json
 import logging
 import asyncio
-from typing import Any
+import time
+from typing import Any, Awaitable, Callable
+from secrets import token_hex
+from urllib.parse import quote
+import fastjsonschema
+import httpx
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from mcp.server import Server
-from mcp.server.sse import SseServerTransport
 from mcp.types import Tool, TextContent
-from starlette.middleware.cors import CORSMiddleware
 from msgraph import GraphServiceClient
-from azure.identity import ClientSecretCredential
+from msgraph.graph_request_adapter import GraphRequestAdapter
+from msgraph_core import GraphClientFactory
+from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+from msgraph.generated.models.password_profile import PasswordProfile
+from msgraph.generated.models.user import User
+from msgraph.generated.users.item.user_item_request_builder import UserItemRequestBuilder
+from msgraph.generated.users.users_request_builder import UsersRequestBuilder
+from kiota_abstractions.base_request_configuration import RequestConfiguration
+from kiota_abstractions.method import Method
+from kiota_abstractions.request_information import RequestInformation
+from kiota_authentication_azure.azure_identity_authentication_provider import AzureIdentityAuthenticationProvider
+from azure.core.credentials import AccessToken
+from azure.identity.aio import ClientSecretCredential
 
 # Configure logging
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -28,108 +44,508 @@ TENANT_ID = os.getenv("AZURE_TENANT_ID")
 CLIENT_ID = os.getenv("AZURE_CLIENT_ID")
 CLIENT_SECRET = os.getenv("AZURE_CLIENT_SECRET")
 
-# Initialize Graph client
-credential = ClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
-graph_client = GraphServiceClient(credential)
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+
+# Upper bound on Graph requests in flight from this process
+GRAPH_CONCURRENCY = int(os.getenv("GRAPH_CONCURRENCY", "16"))
+
+
+class AdmissionController:
+    """Limit in-flight Graph requests, adapting the limit to throttling.
+
+    A 429 or 503 halves the limit once per throttling window. The window
+    lasts for Graph's Retry-After (DEFAULT_BACKOFF seconds if absent), and
+    no new requests are admitted until it has passed. Further throttled
+    responses inside the window only extend it, so a burst of 429s from
+    requests already in flight counts as one event. The limit also drops to
+    the x-ratelimit-remaining quota when Graph reports less. Otherwise each
+    successful response outside a window raises it by one until it reaches
+    max_limit. Waiters block on a Condition, so a resized limit takes
+    effect at once.
+    """
+
+    # Throttling window used when Graph sends no usable Retry-After
+    DEFAULT_BACKOFF = 1.0
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.backoff_until = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._cond:
+            while True:
+                delay = self.backoff_until - time.monotonic()
+                if delay > 0:
+                    # Graph asked us to wait; hold new requests until the window passes
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.active < self.limit:
+                    break
+                else:
+                    await self._cond.wait()
+            self.active += 1
+
+    async def release(self, response: httpx.Response | None) -> None:
+        async with self._cond:
+            self.active -= 1
+            if response is not None:
+                self._observe(response)
+            self._cond.notify_all()
+
+    def _observe(self, response: httpx.Response) -> None:
+        now = time.monotonic()
+        if response.status_code in (429, 503):
+            retry_after = _parse_retry_after(response.headers.get("Retry-After"), self.DEFAULT_BACKOFF)
+            if now >= self.backoff_until:
+                self.limit = max(1, self.limit // 2)
+                logger.warning(
+                    "Graph throttled request (status %d, Retry-After %ss); concurrency limit now %d",
+                    response.status_code, retry_after, self.limit,
+                )
+            self.backoff_until = max(self.backoff_until, now + retry_after)
+            return
+
+        remaining = response.headers.get("x-ratelimit-remaining")
+        if remaining is not None and remaining.isdigit() and int(remaining) < self.limit:
+            self.limit = max(1, int(remaining))
+        elif response.status_code < 400 and self.limit < self.max_limit and now >= self.backoff_until:
+            self.limit += 1
+
+
+def _parse_retry_after(value: str | None, default: float) -> float:
+    """Read a Retry-After header given in seconds, falling back to default."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+class AdmissionTransport(httpx.AsyncBaseTransport):
+    """httpx transport that passes every request through an AdmissionController."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, controller: AdmissionController):
+        self._transport = transport
+        self._controller = controller
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._controller.acquire()
+        response = None
+        try:
+            response = await self._transport.handle_async_request(request)
+            return response
+        finally:
+            await self._controller.release(response)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+graph_admission = AdmissionController(GRAPH_CONCURRENCY)
+
+# Shared HTTP/2 connection pool for every Graph call, so concurrent tool
+# calls reuse warm TLS connections instead of handshaking per request.
+# Admission sits below the SDK middleware, so retries are admitted too;
+# the transport itself never retries, leaving that to the SDK's RetryHandler.
+http_client = httpx.AsyncClient(
+    base_url=GRAPH_BASE_URL,
+    transport=AdmissionTransport(
+        httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=0,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60),
+        ),
+        graph_admission,
+    ),
+    timeout=httpx.Timeout(30.0),
+)
+
+
+class CachingClientSecretCredential(ClientSecretCredential):
+    """ClientSecretCredential that reuses its access token until shortly before expiry.
+
+    The SDK asks for a token on every Graph request; serving it from memory
+    skips the MSAL cache lookup and lets concurrent callers share a single
+    refresh instead of racing to acquire one.
+    """
+
+    # Refresh tokens this many seconds before they expire
+    REFRESH_MARGIN = 60
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_tokens: dict[tuple, AccessToken] = {}
+        self._token_lock = asyncio.Lock()
+
+    def _get_cached_token(self, key: tuple) -> AccessToken | None:
+        token = self._cached_tokens.get(key)
+        if token is None or token.expires_on - time.time() <= self.REFRESH_MARGIN:
+            return None
+        return token
+
+    async def get_token(self, *scopes, claims=None, tenant_id=None, enable_cae=False, **kwargs) -> AccessToken:
+        # Tenant overrides and extra options must always reach Azure AD
+        if tenant_id or kwargs:
+            return await super().get_token(
+                *scopes, claims=claims, tenant_id=tenant_id, enable_cae=enable_cae, **kwargs
+            )
+
+        key = (scopes, enable_cae)
+        if claims:
+            # A claims challenge means Graph revoked the cached token, so the
+            # fresh one replaces it for every later call
+            async with self._token_lock:
+                token = await super().get_token(*scopes, claims=claims, enable_cae=enable_cae)
+                self._cached_tokens[key] = token
+                return token
+        token = self._get_cached_token(key)
+        if token is not None:
+            return token
+        async with self._token_lock:
+            token = self._get_cached_token(key)
+            if token is None:
+                token = await super().get_token(*scopes, enable_cae=enable_cae)
+                self._cached_tokens[key] = token
+            return token
+
+
+# Initialize Graph client. The token is acquired asynchronously and primed
+# during lifespan startup so the first tool calls do not all wait on Azure AD.
+GRAPH_SCOPE = "https://graph.microsoft.com/.default"
+credential = CachingClientSecretCredential(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
+request_adapter = GraphRequestAdapter(
+    AzureIdentityAuthenticationProvider(credential),
+    client=GraphClientFactory.create_with_default_middleware(client=http_client),
+)
+graph_client = GraphServiceClient(request_adapter=request_adapter)
+
+# Microsoft Graph accepts at most 20 sub-requests per JSON batch
+GRAPH_BATCH_LIMIT = 20
+# Graph returns at most 999 users per page of /users
+GRAPH_PAGE_LIMIT = 999
+# Throttled (429) sub-requests are resent this many times before giving up
+GRAPH_BATCH_MAX_RETRIES = 3
+
+# Fields returned for a user by read_user and batch_users reads
+_USER_FIELDS = ("id", "userPrincipalName", "displayName", "mail", "jobTitle", "department", "accountEnabled")
+# Fields returned for each user by list_users
+_USER_LIST_FIELDS = ("id", "userPrincipalName", "displayName", "mail")
+
+# read_user only asks Graph for the fields it returns
+_READ_USER_CONFIG = RequestConfiguration(
+    query_parameters=UserItemRequestBuilder.UserItemRequestBuilderGetQueryParameters(
+        select=list(_USER_FIELDS),
+    ),
+)
+
+# read_user results are cached per userId, and list_users results per
+# (`top`, `count`), for this many seconds. Any write through this server
+# invalidates them.
+USER_CACHE_TTL = 120
+USER_CACHE_SIZE = 10_000
+_user_cache: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_locks: dict[str, asyncio.Lock] = {}
+# Maps a user's id and userPrincipalName to the _user_cache keys holding them,
+# so invalidation never scans the cache. Entries live as long as the cache's.
+_user_cache_index: TTLCache = TTLCache(maxsize=2 * USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_list_cache: TTLCache = TTLCache(maxsize=64, ttl=USER_CACHE_TTL)
 
 # Create MCP server
 mcp_server = Server("microsoft-graph-mcp")
 
 
-@mcp_server.list_tools()
-async def list_tools() -> list[Tool]:
-    """List available Microsoft Graph user management tools."""
-    return [
-        Tool(
-            name="create_user",
-            description="Create a new user in Azure AD",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "userPrincipalName": {"type": "string", "description": "User's email address"},
-                    "displayName": {"type": "string", "description": "User's display name"},
-                    "mailNickname": {"type": "string", "description": "Mail alias"},
-                    "password": {"type": "string", "description": "Initial password"},
-                },
-                "required": ["userPrincipalName", "displayName", "mailNickname", "password"],
+_CREATE_USER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "userPrincipalName": {"type": "string", "description": "User's email address"},
+        "displayName": {"type": "string", "description": "User's display name"},
+        "mailNickname": {"type": "string", "description": "Mail alias"},
+        "password": {"type": "string", "description": "Initial password"},
+    },
+    "required": ["userPrincipalName", "displayName", "mailNickname", "password"],
+}
+_UPDATE_USER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "userId": {"type": "string", "description": "User ID or userPrincipalName"},
+        "displayName": {"type": "string", "description": "New display name"},
+        "jobTitle": {"type": "string", "description": "Job title"},
+        "department": {"type": "string", "description": "Department"},
+    },
+    "required": ["userId"],
+}
+_BATCH_UPDATE_BODY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        field: _UPDATE_USER_SCHEMA["properties"][field]
+        for field in ("displayName", "jobTitle", "department")
+    },
+    "additionalProperties": False,
+    "minProperties": 1,
+}
+# bulk_update_users items must change at least one field; an empty PATCH
+# would otherwise be reported as a success
+_BULK_UPDATE_ITEM_SCHEMA = {
+    **_UPDATE_USER_SCHEMA,
+    "anyOf": [{"required": [field]} for field in ("displayName", "jobTitle", "department")],
+}
+# Tool definitions are static, so build them and their wire form once at import
+_TOOLS: list[Tool] = [
+    Tool(
+        name="create_user",
+        description="Create a new user in Azure AD",
+        inputSchema=_CREATE_USER_SCHEMA,
+    ),
+    Tool(
+        name="read_user",
+        description="Get user information from Azure AD",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "userId": {"type": "string", "description": "User ID or userPrincipalName"},
             },
-        ),
-        Tool(
-            name="read_user",
-            description="Get user information from Azure AD",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "userId": {"type": "string", "description": "User ID or userPrincipalName"},
-                },
-                "required": ["userId"],
+            "required": ["userId"],
+        },
+    ),
+    Tool(
+        name="update_user",
+        description="Update an existing user in Azure AD",
+        inputSchema=_UPDATE_USER_SCHEMA,
+    ),
+    Tool(
+        name="delete_user",
+        description="Delete a user from Azure AD",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "userId": {"type": "string", "description": "User ID or userPrincipalName"},
             },
-        ),
-        Tool(
-            name="update_user",
-            description="Update an existing user in Azure AD",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "userId": {"type": "string", "description": "User ID or userPrincipalName"},
-                    "displayName": {"type": "string", "description": "New display name"},
-                    "jobTitle": {"type": "string", "description": "Job title"},
-                    "department": {"type": "string", "description": "Department"},
+            "required": ["userId"],
+        },
+    ),
+    Tool(
+      name="list_users",
+      description="List users in the Azure AD tenant",
+      inputSchema={
+        "type": "object",
+        "properties": {
+            "top": {"type": "integer", "description": "Number of users to return (default 10)", "default": 10, "minimum": 1},
+            "count": {"type": "boolean", "description": "Also return the total number of users in the tenant", "default": False},
+        },
+      },
+    ),
+    Tool(
+        name="bulk_create_users",
+        description="Create multiple users in Azure AD using a single batched Graph request",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "users": {"type": "array", "description": "Users to create", "items": _CREATE_USER_SCHEMA},
+            },
+            "required": ["users"],
+        },
+    ),
+    Tool(
+        name="bulk_update_users",
+        description="Update multiple users in Azure AD using a single batched Graph request",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "users": {"type": "array", "description": "User updates to apply", "items": _BULK_UPDATE_ITEM_SCHEMA},
+            },
+            "required": ["users"],
+        },
+    ),
+    Tool(
+        name="bulk_delete_users",
+        description="Delete multiple users from Azure AD using a single batched Graph request",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "userIds": {
+                    "type": "array",
+                    "description": "User IDs or userPrincipalNames to delete",
+                    "items": {"type": "string"},
                 },
-                "required": ["userId"],
             },
-        ),
-        Tool(
-            name="delete_user",
-            description="Delete a user from Azure AD",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "userId": {"type": "string", "description": "User ID or userPrincipalName"},
+            "required": ["userIds"],
+        },
+    ),
+    Tool(
+        name="batch_users",
+        description="Run a mix of create, read, update and delete operations on users in Azure AD "
+                    "using batched Graph requests. Operations may execute in any order, so do not "
+                    "combine operations that depend on each other (such as an update and a read of "
+                    "the same user) in one call",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "operations": {
+                    "type": "array",
+                    "description": "Independent operations to run; execution order is not guaranteed, "
+                                   "but results are returned in the same order",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "op": {"type": "string", "enum": ["create", "read", "update", "delete"]},
+                            "userId": {"type": "string", "description": "User ID or userPrincipalName (read, update, delete)"},
+                            "body": {"type": "object", "description": "User fields (create, update)"},
+                        },
+                        "required": ["op"],
+                        "allOf": [
+                            {
+                                "if": {"properties": {"op": {"const": "create"}}, "required": ["op"]},
+                                "then": {"properties": {"body": _CREATE_USER_SCHEMA}, "required": ["body"]},
+                                "else": {"required": ["userId"]},
+                            },
+                            {
+                                # Only fields update_user can change; anything else would be
+                                # silently dropped from the PATCH
+                                "if": {"properties": {"op": {"const": "update"}}, "required": ["op"]},
+                                "then": {"properties": {"body": _BATCH_UPDATE_BODY_SCHEMA}, "required": ["body"]},
+                            },
+                        ],
+                    },
                 },
-                "required": ["userId"],
             },
-        ),
-        Tool(
-          name="list_users",
-          description="List users in the Azure AD tenant",
-          inputSchema={
+            "required": ["operations"],
+        },
+    ),
+    Tool(
+        name="bulk_read_users",
+        description="Get information for multiple users from Azure AD concurrently",
+        inputSchema={
             "type": "object",
             "properties": {
-                "top": {"type": "integer", "description": "Number of users to return (default 10, max 999)", "default": 10},
+                "userIds": {
+                    "type": "array",
+                    "description": "User IDs or userPrincipalNames to read",
+                    "items": {"type": "string"},
+                },
             },
-          },
-        ),
-    ]
+            "required": ["userIds"],
+        },
+    ),
+]
+# Tool objects never change after import, so their wire form is built once
+_TOOLS_DICTS = [
+    {"name": tool.name, "description": tool.description, "inputSchema": tool.inputSchema}
+    for tool in _TOOLS
+]
 
 
-@mcp_server.call_tool()
-async def call_tool(name: str, arguments: Any) -> list[TextContent]:
-    """Handle tool execution for Microsoft Graph operations."""
+# Validators generated from each tool's inputSchema once at import
+_VALIDATORS = {tool.name: fastjsonschema.compile(tool.inputSchema) for tool in _TOOLS}
+
+# JSON-RPC responses whose result never changes are pre-encoded; only the
+# request id is spliced in between the prefix and the suffix.
+_RPC_PREFIX = b'{"jsonrpc":"2.0","id":'
+_INITIALIZE_SUFFIX = b',"result":' + orjson.dumps({
+    "protocolVersion": "2025-06-18",
+    "capabilities": {
+        "tools": {}
+    },
+    "serverInfo": {
+        "name": "microsoft-graph-mcp",
+        "version": "1.0.0"
+    }
+}) + b'}'
+_TOOLS_LIST_SUFFIX = b',"result":' + orjson.dumps({"tools": _TOOLS_DICTS}) + b'}'
+
+
+@mcp_server.list_tools()
+async def list_tools() -> list[Tool]:
+    """List available Microsoft Graph user management tools."""
+    return _TOOLS
+
+
+def _user_url(user_id: str) -> str:
+    """Build the relative Graph URL for a single user.
+
+    The id is escaped completely, as by_user_id does, so a "/" or ".." in it
+    cannot reach a path other than the named user.
+    """
+    return f"/users/{quote(user_id, safe='')}"
+
+
+def _create_user_request(arguments: dict) -> dict:
+    """Build a $batch sub-request that creates a user."""
+    return {
+        "method": "POST",
+        "url": "/users",
+        "headers": {"Content-Type": "application/json"},
+        "body": {
+            "accountEnabled": True,
+            "userPrincipalName": arguments["userPrincipalName"],
+            "displayName": arguments["displayName"],
+            "mailNickname": arguments["mailNickname"],
+            "passwordProfile": {
+                "password": arguments["password"],
+                "forceChangePasswordNextSignIn": True,
+            },
+        },
+    }
+
+
+def _update_user_request(arguments: dict) -> dict:
+    """Build a $batch sub-request that patches a user."""
+    body = {
+        field: arguments[field]
+        for field in ("displayName", "jobTitle", "department")
+        if field in arguments
+    }
+    return {
+        "method": "PATCH",
+        "url": _user_url(arguments["userId"]),
+        "headers": {"Content-Type": "application/json"},
+        "body": body,
+    }
+
+
+def _delete_user_request(user_id: str) -> dict:
+    """Build a $batch sub-request that deletes a user."""
+    return {"method": "DELETE", "url": _user_url(user_id)}
+
+
+def _read_user_request(user_id: str) -> dict:
+    """Build a $batch sub-request that reads a user."""
+    return {"method": "GET", "url": f"{_user_url(user_id)}?$select={','.join(_USER_FIELDS)}"}
+
+
+def _retry_after(response: dict, attempt: int) -> float:
+    """Seconds to wait before resending a throttled sub-request.
+
+    Honours the sub-response's Retry-After header and falls back to
+    exponential backoff when Graph does not send one.
+    """
+    for name, value in (response.get("headers") or {}).items():
+        if name.lower() == "retry-after" and str(value).isdigit():
+            return int(value)
+    return 2 ** attempt
+
+
+async def _read_user(user_id: str) -> dict:
+    """Fetch a user from Graph, serving repeat lookups from the TTL cache.
+
+    Concurrent misses for the same userId wait on one lock so only a
+    single Graph request is made.
+    """
+    user_data = _user_cache.get(user_id)
+    if user_data is not None:
+        return user_data
+
+    lock = _user_cache_locks.setdefault(user_id, asyncio.Lock())
     try:
-        if name == "create_user":
-            from msgraph.generated.models.user import User
-            from msgraph.generated.models.password_profile import PasswordProfile
-
-            user = User()
-            user.user_principal_name = arguments["userPrincipalName"]
-            user.display_name = arguments["displayName"]
-            user.mail_nickname = arguments["mailNickname"]
-            user.account_enabled = True
-
-            password_profile = PasswordProfile()
-            password_profile.password = arguments["password"]
-            password_profile.force_change_password_next_sign_in = True
-            user.password_profile = password_profile
-
-            result = await graph_client.users.post(user)
-            return [TextContent(
-                type="text",
-                text=f"User created successfully: {result.id}\n{json.dumps({'id': result.id, 'userPrincipalName': result.user_principal_name, 'displayName': result.display_name}, indent=2)}"
-            )]
-
-        elif name == "read_user":
-            user = await graph_client.users.by_user_id(arguments["userId"]).get()
+        async with lock:
+            user_data = _user_cache.get(user_id)
+            if user_data is not None:
+                return user_data
+
+            user = await graph_client.users.by_user_id(user_id).get(request_configuration=_READ_USER_CONFIG)
             user_data = {
                 "id": user.id,
                 "userPrincipalName": user.user_principal_name,
@@ -139,350 +555,712 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
                 "department": user.department,
                 "accountEnabled": user.account_enabled,
             }
-            return [TextContent(type="text", text=json.dumps(user_data, indent=2))]
-
-        elif name == "update_user":
-            from msgraph.generated.models.user import User
-
-            user = User()
-            if "displayName" in arguments:
-                user.display_name = arguments["displayName"]
-            if "jobTitle" in arguments:
-                user.job_title = arguments["jobTitle"]
-            if "department" in arguments:
-                user.department = arguments["department"]
-
-            await graph_client.users.by_user_id(arguments["userId"]).patch(user)
-            return [TextContent(type="text", text=f"User {arguments['userId']} updated successfully")]
-
-        elif name == "delete_user":
-            await graph_client.users.by_user_id(arguments["userId"]).delete()
-            return [TextContent(type="text", text=f"User {arguments['userId']} deleted successfully")]
-        
-        elif name == "list_users":
-            # Get the 'top' parameter, default to 10 if not provided
-            top_count = arguments.get("top", 10)
-    
-            # 1. Define a local function to handle the configuration
-            def configure_query(config):
-                config.query_parameters.top = top_count
-    
-            # 2. Pass that function to the request
-            users_page = await graph_client.users.get(
-                request_configuration=configure_query
-            )
-    
-            user_list = []
-            if users_page and users_page.value:
-                for user in users_page.value:
-                    user_list.append({
-                        "id": user.id,
-                        "userPrincipalName": user.user_principal_name,
-                        "displayName": user.display_name,
-                        "mail": user.mail
-                    })
-
-            return [TextContent(
-                type="text", 
-                text=json.dumps({"users": user_list, "count": len(user_list)}, indent=2)
-            )]
+            _user_cache[user_id] = user_data
+            for alias in (user_data["id"], user_data["userPrincipalName"]):
+                if alias and alias != user_id:
+                    _user_cache_index[alias] = _user_cache_index.get(alias, frozenset()) | {user_id}
+            return user_data
+    finally:
+        if not lock.locked():
+            _user_cache_locks.pop(user_id, None)
 
+
+def _invalidate_users(user_ids: list[str]) -> None:
+    """Drop cached entries for users, whether keyed by id or userPrincipalName.
+
+    Cached user lists may contain the users too, so they are dropped as well.
+    """
+    for user_id in user_ids:
+        _user_cache.pop(user_id, None)
+        for key in _user_cache_index.pop(user_id, ()):
+            _user_cache.pop(key, None)
+    _user_list_cache.clear()
+
+
+async def _post_graph_batch(requests: list[dict]) -> list[dict]:
+    """POST a single $batch payload and return its sub-responses."""
+    request_info = RequestInformation(Method.POST, "{+baseurl}/$batch")
+    request_info.headers.try_add("Accept", "application/json")
+    request_info.set_stream_content(orjson.dumps({"requests": requests}), "application/json")
+    content = await graph_client.request_adapter.send_primitive_async(
+        request_info, "bytes", {"XXX": ODataError}
+    )
+    return orjson.loads(content)["responses"]
+
+
+async def _graph_batch(requests: list[dict]) -> dict[str, dict]:
+    """Send sub-requests through Graph JSON batching.
+
+    Requests are split into batches of GRAPH_BATCH_LIMIT which are posted
+    concurrently. Each request needs a unique "id"; the sub-responses are
+    returned keyed by that id. Sub-requests throttled with a 429 are resent
+    after their Retry-After delay, up to GRAPH_BATCH_MAX_RETRIES times.
+    """
+    responses = {}
+    pending = requests
+    for attempt in range(GRAPH_BATCH_MAX_RETRIES + 1):
+        chunks = [
+            pending[i:i + GRAPH_BATCH_LIMIT]
+            for i in range(0, len(pending), GRAPH_BATCH_LIMIT)
+        ]
+        batches = await asyncio.gather(*(_post_graph_batch(chunk) for chunk in chunks))
+
+        by_id = {request["id"]: request for request in pending}
+        throttled = []
+        delay = 0
+        for batch in batches:
+            for response in batch:
+                responses[response["id"]] = response
+                if response.get("status") == 429 and attempt < GRAPH_BATCH_MAX_RETRIES:
+                    throttled.append(by_id[response["id"]])
+                    delay = max(delay, _retry_after(response, attempt))
+        if not throttled:
+            break
+
+        logger.warning(
+            "Graph throttled %d batch sub-requests; retrying in %ss", len(throttled), delay
+        )
+        await asyncio.sleep(delay)
+        pending = throttled
+    return responses
+
+
+async def _run_bulk(requests: list[dict], labels: list[str]) -> list[TextContent]:
+    """Execute sub-requests as a batch and summarise the per-user outcome."""
+    for index, request in enumerate(requests):
+        request["id"] = str(index)
+
+    responses = await _graph_batch(requests)
+
+    results = []
+    for index, label in enumerate(labels):
+        response = responses.get(str(index), {})
+        status = response.get("status")
+        # Bodies are usually JSON objects, but Graph can also return null or
+        # a base64 string for non-JSON payloads
+        body = response.get("body")
+        if not isinstance(body, dict):
+            body = {}
+        result = {"user": label, "status": status}
+        if status is not None and status < 400:
+            if requests[index]["method"] == "GET":
+                result["data"] = {field: body.get(field) for field in _USER_FIELDS}
+            elif "id" in body:
+                result["id"] = body["id"]
+        elif status is None:
+            result["error"] = "No response for sub-request"
         else:
-            return [TextContent(type="text", text=f"Unknown tool: {name}")]
+            error = body.get("error")
+            message = error.get("message") if isinstance(error, dict) else None
+            result["error"] = message or f"Request failed with status {status}"
+        results.append(result)
 
-    except Exception as e:
-        # Parse Microsoft Graph API errors for better messages
-        error_msg = str(e)
-        if "Request_ResourceNotFound" in error_msg:
-            return [TextContent(type="text", text=f"Error: User '{arguments.get('userId', 'unknown')}' not found in Azure AD. Please verify the user ID or userPrincipalName.")]
-        elif "Request_BadRequest" in error_msg:
-            return [TextContent(type="text", text=f"Error: Invalid request. Please check the parameters: {error_msg}")]
-        elif "Authorization_RequestDenied" in error_msg or "Forbidden" in error_msg:
-            return [TextContent(type="text", text=f"Error: Permission denied. Ensure the app has the required Graph API permissions (User.ReadWrite.All).")]
+    succeeded = sum(1 for result in results if "error" not in result)
+    return [TextContent(
+        type="text",
+        text=f"Batch completed: {succeeded}/{len(results)} succeeded\n{orjson.dumps(results).decode()}"
+    )]
+
+
+async def _handle_create_user(arguments: dict) -> list[TextContent]:
+    """Create a single user."""
+    user = User()
+    user.user_principal_name = arguments["userPrincipalName"]
+    user.display_name = arguments["displayName"]
+    user.mail_nickname = arguments["mailNickname"]
+    user.account_enabled = True
+
+    password_profile = PasswordProfile()
+    password_profile.password = arguments["password"]
+    password_profile.force_change_password_next_sign_in = True
+    user.password_profile = password_profile
+
+    result = await graph_client.users.post(user)
+    _user_list_cache.clear()
+    return [TextContent(
+        type="text",
+        text=f"User created successfully: {result.id}\n{orjson.dumps({'id': result.id, 'userPrincipalName': result.user_principal_name, 'displayName': result.display_name}).decode()}"
+    )]
+
+
+async def _handle_read_user(arguments: dict) -> list[TextContent]:
+    """Return a user's profile, served from the TTL cache when warm."""
+    user_data = await _read_user(arguments["userId"])
+    return [TextContent(type="text", text=orjson.dumps(user_data).decode())]
+
+
+async def _handle_update_user(arguments: dict) -> list[TextContent]:
+    """Patch the supplied fields on a user."""
+    user = User()
+    if "displayName" in arguments:
+        user.display_name = arguments["displayName"]
+    if "jobTitle" in arguments:
+        user.job_title = arguments["jobTitle"]
+    if "department" in arguments:
+        user.department = arguments["department"]
+
+    await graph_client.users.by_user_id(arguments["userId"]).patch(user)
+    _invalidate_users([arguments["userId"]])
+    return [TextContent(type="text", text=f"User {arguments['userId']} updated successfully")]
+
+
+async def _handle_delete_user(arguments: dict) -> list[TextContent]:
+    """Delete a user."""
+    await graph_client.users.by_user_id(arguments["userId"]).delete()
+    _invalidate_users([arguments["userId"]])
+    return [TextContent(type="text", text=f"User {arguments['userId']} deleted successfully")]
+
+
+async def _handle_list_users(arguments: dict) -> list[TextContent]:
+    """List the first `top` users in the tenant, served from the TTL cache when warm."""
+    # Get the 'top' parameter, default to 10 if not provided
+    top_count = arguments.get("top", 10)
+    include_total = arguments.get("count", False)
+    cache_key = (top_count, include_total)
+    result = _user_list_cache.get(cache_key)
+    if result is None:
+        result = await _list_users(top_count, include_total)
+        _user_list_cache[cache_key] = result
+    return [TextContent(type="text", text=orjson.dumps(result).decode())]
+
+
+async def _list_users(top_count: int, include_total: bool) -> dict:
+    """Fetch the first `top_count` users, plus the tenant total if asked."""
+    # Ask for as much as one page allows, then follow @odata.nextLink until
+    # `top` users are collected. Each link comes from the previous page, so
+    # the pages are necessarily fetched one after another. $select carries
+    # over into the nextLinks.
+    config = RequestConfiguration(
+        query_parameters=UsersRequestBuilder.UsersRequestBuilderGetQueryParameters(
+            select=list(_USER_LIST_FIELDS),
+            top=min(top_count, GRAPH_PAGE_LIMIT),
+            # $count=true returns the total with the first page, in the same request
+            count=True if include_total else None,
+        ),
+    )
+    if include_total:
+        # Graph only counts directory objects with eventual consistency
+        config.headers.add("ConsistencyLevel", "eventual")
+    users_page = await graph_client.users.get(request_configuration=config)
+    total = users_page.odata_count if users_page else None
+
+    # Counted queries need the ConsistencyLevel header on every page
+    next_config = RequestConfiguration(headers=config.headers) if include_total else None
+    users = list(users_page.value or []) if users_page else []
+    while users_page and users_page.odata_next_link and len(users) < top_count:
+        users_page = await graph_client.users.with_url(users_page.odata_next_link).get(
+            request_configuration=next_config
+        )
+        users.extend(users_page.value or [])
+
+    user_list = [
+        {
+            "id": user.id,
+            "userPrincipalName": user.user_principal_name,
+            "displayName": user.display_name,
+            "mail": user.mail
+        }
+        for user in users[:top_count]
+    ]
+    result = {"users": user_list, "count": len(user_list)}
+    if include_total:
+        result["total"] = total
+    return result
+
+
+async def _handle_bulk_create_users(arguments: dict) -> list[TextContent]:
+    """Create many users through Graph JSON batching."""
+    users = arguments["users"]
+    try:
+        return await _run_bulk(
+            [_create_user_request(user) for user in users],
+            [user["userPrincipalName"] for user in users],
+        )
+    finally:
+        _user_list_cache.clear()
+
+
+async def _handle_bulk_update_users(arguments: dict) -> list[TextContent]:
+    """Update many users through Graph JSON batching."""
+    users = arguments["users"]
+    try:
+        return await _run_bulk(
+            [_update_user_request(user) for user in users],
+            [user["userId"] for user in users],
+        )
+    finally:
+        _invalidate_users([user["userId"] for user in users])
+
+
+async def _handle_bulk_delete_users(arguments: dict) -> list[TextContent]:
+    """Delete many users through Graph JSON batching."""
+    user_ids = arguments["userIds"]
+    try:
+        return await _run_bulk(
+            [_delete_user_request(user_id) for user_id in user_ids],
+            list(user_ids),
+        )
+    finally:
+        _invalidate_users(user_ids)
+
+
+async def _handle_batch_users(arguments: dict) -> list[TextContent]:
+    """Run mixed user operations through Graph JSON batching.
+
+    Graph runs the sub-requests of a $batch in any order and the chunks are
+    posted concurrently, so only the order of the results is guaranteed.
+    """
+    operations = arguments["operations"]
+    requests = []
+    labels = []
+    for operation in operations:
+        op = operation["op"]
+        body = operation.get("body", {})
+        if op == "create":
+            requests.append(_create_user_request(body))
+            labels.append(body["userPrincipalName"])
+        elif op == "read":
+            requests.append(_read_user_request(operation["userId"]))
+            labels.append(operation["userId"])
+        elif op == "update":
+            requests.append(_update_user_request({**body, "userId": operation["userId"]}))
+            labels.append(operation["userId"])
+        else:
+            requests.append(_delete_user_request(operation["userId"]))
+            labels.append(operation["userId"])
+
+    try:
+        return await _run_bulk(requests, labels)
+    finally:
+        if any(operation["op"] != "read" for operation in operations):
+            _invalidate_users([
+                operation["userId"] for operation in operations
+                if operation["op"] in ("update", "delete")
+            ])
+
+
+async def _handle_bulk_read_users(arguments: dict) -> list[TextContent]:
+    """Read many users concurrently, bounded by the Graph admission controller.
+
+    Lookups go through the read_user cache, so warm entries cost nothing
+    and duplicate ids share one Graph request.
+    """
+    user_ids = arguments["userIds"]
+    results = await asyncio.gather(
+        *(_read_user(user_id) for user_id in user_ids), return_exceptions=True
+    )
+
+    users = []
+    errors = []
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            errors.append({"userId": user_id, "error": str(result)})
         else:
-            return [TextContent(type="text", text=f"Error: {error_msg}")]
+            users.append(result)
+    return [TextContent(
+        type="text",
+        text=orjson.dumps({"users": users, "errors": errors}).decode()
+    )]
+
+
+_HANDLERS: dict[str, Callable[[dict], Awaitable[list[TextContent]]]] = {
+    "create_user": _handle_create_user,
+    "read_user": _handle_read_user,
+    "update_user": _handle_update_user,
+    "delete_user": _handle_delete_user,
+    "list_users": _handle_list_users,
+    "bulk_create_users": _handle_bulk_create_users,
+    "bulk_update_users": _handle_bulk_update_users,
+    "bulk_delete_users": _handle_bulk_delete_users,
+    "batch_users": _handle_batch_users,
+    "bulk_read_users": _handle_bulk_read_users,
+}
+
+
+@mcp_server.call_tool()
+async def call_tool(name: str, arguments: Any) -> list[TextContent]:
+    """Handle tool execution for Microsoft Graph operations."""
+    handler = _HANDLERS.get(name)
+    if handler is None:
+        return [TextContent(type="text", text=f"Unknown tool: {name}")]
+
+    try:
+        # Validation also fills in schema defaults such as list_users' top
+        arguments = _VALIDATORS[name](arguments)
+    except fastjsonschema.JsonSchemaException as e:
+        return [TextContent(type="text", text=f"Error: Invalid arguments for {name}: {e.message}")]
+
+    try:
+        return await handler(arguments)
+    except Exception as e:
+        return [TextContent(type="text", text=_format_error(name, arguments, e))]
+
+
+# Tools whose failures can be a missing user or a rejected payload; other
+# tools skip those mappings when formatting an error
+_SINGLE_USER_TOOLS = frozenset({"read_user", "update_user", "delete_user"})
+_WRITE_TOOLS = frozenset({"create_user", "update_user"})
+_PERMISSION_DENIED = "Error: Permission denied. Ensure the app has the required Graph API permissions (User.ReadWrite.All)."
+
+# Friendlier messages for Graph error codes, keyed on ODataError.error.code.
+# Each entry names the tools it applies to (None for all); templates may use
+# {userId} from the tool arguments and {message} for Graph's own text.
+_ERR_MAP: dict[str, tuple[frozenset[str] | None, str]] = {
+    "Request_ResourceNotFound": (
+        _SINGLE_USER_TOOLS,
+        "Error: User '{userId}' not found in Azure AD. Please verify the user ID or userPrincipalName.",
+    ),
+    "Request_BadRequest": (_WRITE_TOOLS, "Error: Invalid request. Please check the parameters: {message}"),
+    "Authorization_RequestDenied": (None, _PERMISSION_DENIED),
+}
+
+
+def _format_error(name: str, arguments: dict, error: Exception) -> str:
+    """Turn a failed tool call into a readable message for the caller."""
+    if isinstance(error, ODataError):
+        code = error.error.code if error.error else None
+        tools, template = _ERR_MAP.get(code, (None, None))
+        if template is not None and (tools is None or name in tools):
+            return template.format(userId=arguments.get("userId", "unknown"), message=error)
+        if error.response_status_code == 403:
+            return _PERMISSION_DENIED
+    return f"Error: {error}"
 
 
 # Don't use SseServerTransport - it has complex session management
 # Instead, implement simple HTTP streaming directly
 logger.info("Creating MCP server handler")
 
-async def mcp_asgi_app(scope, receive, send):
-    """Raw ASGI application for handling MCP connections."""
-    logger.info("="*80)
-    logger.info(f"========== NEW REQUEST ==========")
-    logger.info("="*80)
-    logger.info(f"Request type: {scope.get('type')}")
-    logger.info(f"Request method: {scope.get('method')}")
-    logger.info(f"Request path: {scope.get('path')}")
-    logger.info(f"Query string: {scope.get('query_string', b'').decode()}")
-    logger.info(f"Client: {scope.get('client')}")
-    logger.info(f"Scheme: {scope.get('scheme')}")
-    logger.info(f"Server: {scope.get('server')}")
-
-    # Parse and log headers nicely
-    headers_dict = {}
-    for key, value in scope.get('headers', []):
-        headers_dict[key.decode()] = value.decode()
-    logger.info("Headers:")
-    for k, v in headers_dict.items():
-        logger.info(f"  {k}: {v}")
-
-    logger.info("="*80)
+# Every response allows any origin. CORS is handled inline rather than
+# through Starlette's CORSMiddleware to avoid wrapping each request.
+_CORS_ALLOW_ORIGIN = [b"access-control-allow-origin", b"*"]
+_CT_JSON = [b"content-type", b"application/json"]
 
-    if scope["type"] != "http":
-        logger.warning(f"Non-HTTP request type: {scope['type']}")
-        return
 
-    # Only handle /mcp path
-    if scope["path"] != "/mcp":
-        logger.warning(f"Path mismatch: {scope['path']} != /mcp")
-        await send({
-            "type": "http.response.start",
-            "status": 404,
-            "headers": [[b"content-type", b"text/plain"]],
-        })
-        await send({
-            "type": "http.response.body",
-            "body": b"Not Found",
-        })
-        return
+def _cl(n: int) -> list[bytes]:
+    """Build a content-length header; b"%d" avoids the str() round-trip."""
+    return [b"content-length", b"%d" % n]
+
+
+# The SSE handshake is identical for every client apart from the session id
+_SSE_START = {
+    "type": "http.response.start",
+    "status": 200,
+    "headers": [
+        [b"content-type", b"text/event-stream"],
+        [b"cache-control", b"no-cache"],
+        [b"connection", b"keep-alive"],
+        _CORS_ALLOW_ORIGIN,
+    ],
+}
+_ENDPOINT_EVENT_PREFIX = b"event: endpoint\ndata: /mcp?session_id="
+SSE_KEEPALIVE_INTERVAL = 15
+_SSE_KEEPALIVE = {"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True}
+
+# CORS preflight answer: allow the methods /mcp serves with any headers.
+# The "*" wildcard does not cover Authorization and is ignored on
+# credentialed requests, so preflights that list their headers get them
+# echoed back, as Starlette's CORSMiddleware did with allow_headers=["*"].
+_PREFLIGHT_BASE_HEADERS = [
+    _CORS_ALLOW_ORIGIN,
+    [b"access-control-allow-methods", b"GET, POST, OPTIONS"],
+    [b"access-control-max-age", b"600"],
+]
+_PREFLIGHT_HEADERS = _PREFLIGHT_BASE_HEADERS + [[b"access-control-allow-headers", b"*"]]
+# Static responses are built once and sent as-is
+_TEXT_HEADERS = [[b"content-type", b"text/plain"], _CORS_ALLOW_ORIGIN]
+_NOT_FOUND_START = {"type": "http.response.start", "status": 404, "headers": _TEXT_HEADERS}
+_NOT_FOUND_BODY = {"type": "http.response.body", "body": b"Not Found"}
+_METHOD_NOT_ALLOWED_START = {"type": "http.response.start", "status": 405, "headers": _TEXT_HEADERS}
+_METHOD_NOT_ALLOWED_BODY = {"type": "http.response.body", "body": b"Method Not Allowed"}
+_PREFLIGHT_START = {"type": "http.response.start", "status": 204, "headers": _PREFLIGHT_HEADERS}
+_EMPTY_BODY = {"type": "http.response.body", "body": b""}
+
+
+async def lifespan(receive, send):
+    """Handle ASGI lifespan events for the server process."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                # Kiota requests tokens with CAE enabled, so prime that cache entry
+                await credential.get_token(GRAPH_SCOPE, enable_cae=True)
+                logger.info("Acquired Graph access token")
+            except Exception as e:
+                # Serve anyway; tool calls will retry and report the failure
+                logger.warning("Could not acquire Graph access token at startup: %s", e)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await http_client.aclose()
+            await credential.close()
+            logger.info("Closed Graph HTTP connection pool")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _method_not_allowed(scope, receive, send):
+    """Reject methods /mcp does not serve."""
+    logger.warning("Unsupported method: %s", scope["method"])
+    await send(_METHOD_NOT_ALLOWED_START)
+    await send(_METHOD_NOT_ALLOWED_BODY)
+
+
+async def _handle_get(scope, receive, send):
+    """Open an SSE stream and announce the POST endpoint for the session."""
+    # For SSE clients, establish a server-sent events stream
+    session_id = token_hex(16)
+
+    # Send SSE headers
+    await send(_SSE_START)
+
+    # Send the endpoint event with session_id
+    await send({
+        "type": "http.response.body",
+        "body": _ENDPOINT_EVENT_PREFIX + session_id.encode() + b"\n\n",
+        "more_body": True,
+    })
+    logger.info("SSE session %s established", session_id)
+
+    # Keep connection alive - wait for disconnect. receive() suspends until
+    # the next ASGI event; an idle stream gets an SSE comment every
+    # SSE_KEEPALIVE_INTERVAL seconds so proxies do not drop it.
+    try:
+        message_count = 0
+        while True:
+            try:
+                message = await asyncio.wait_for(receive(), timeout=SSE_KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                await send(_SSE_KEEPALIVE)
+                continue
+            message_count += 1
+            logger.debug("SSE session %s: received message #%d: %s", session_id, message_count, message)
+
+            if message["type"] == "http.disconnect":
+                logger.info("SSE session %s disconnected after %d messages", session_id, message_count)
+                break
+    except Exception as e:
+        logger.error("SSE connection error for session %s: %s", session_id, e, exc_info=True)
+
+
+async def _rpc_initialize(request_data: dict) -> bytes:
+    """Answer initialize with the pre-encoded server capabilities."""
+    return _RPC_PREFIX + orjson.dumps(request_data["id"]) + _INITIALIZE_SUFFIX
+
+
+async def _rpc_tools_list(request_data: dict) -> bytes:
+    """Answer tools/list with the pre-encoded tool definitions."""
+    return _RPC_PREFIX + orjson.dumps(request_data["id"]) + _TOOLS_LIST_SUFFIX
 
-    if scope["method"] == "GET":
-        logger.info(">>> Handling GET request - establishing SSE connection")
-        # For SSE clients, establish a server-sent events stream
-        import uuid
-        session_id = str(uuid.uuid4())
-        logger.info(f">>> Created session: {session_id}")
 
-        # Send SSE headers
-        logger.info(">>> Sending SSE response headers")
+async def _rpc_tools_call(request_data: dict) -> bytes:
+    """Run a tool and encode its result.
+
+    The content items are encoded with orjson and joined behind the
+    JSON-RPC prefix, so the response goes out with a content-length like
+    every other method. A failing tool is reported as a JSON-RPC error.
+    """
+    if "id" not in request_data:
+        return _rpc_error(None, -32600, "Invalid request: tools/call requires an id")
+    request_id = request_data["id"]
+    params = request_data.get("params")
+    if not isinstance(params, dict) or not isinstance(params.get("name"), str):
+        return _rpc_error(request_id, -32602, "Invalid params: tools/call requires a tool name")
+    tool_name = params["name"]
+    arguments = params.get("arguments", {})
+    if not isinstance(arguments, dict):
+        return _rpc_error(request_id, -32602, "Invalid params: arguments must be an object")
+    logger.debug("Calling tool %s with arguments %s", tool_name, arguments)
+
+    try:
+        result = await call_tool(tool_name, arguments)
+        items = [orjson.dumps({"type": item.type, "text": item.text}) for item in result]
+    except Exception as e:
+        logger.error("Error in tools/call %s: %s", tool_name, e, exc_info=True)
+        return _rpc_error(request_id, -32603, str(e))
+
+    return _RPC_PREFIX + orjson.dumps(request_id) + b',"result":{"content":[' + b",".join(items) + b"]}}"
+
+
+def _rpc_error(request_id: Any, code: int, message: str) -> bytes:
+    """Encode a JSON-RPC error response."""
+    return orjson.dumps({
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "error": {"code": code, "message": message},
+    })
+
+
+def _rpc_method_not_found(request_data: dict) -> bytes:
+    """Encode the JSON-RPC error for an unsupported method."""
+    return _rpc_error(request_data.get("id"), -32601, f"Method not found: {request_data.get('method')}")
+
+
+_RPC_HANDLERS: dict[str, Callable[[dict], Awaitable[bytes]]] = {
+    "initialize": _rpc_initialize,
+    "tools/list": _rpc_tools_list,
+    "tools/call": _rpc_tools_call,
+}
+
+
+async def _handle_post(scope, receive, send):
+    """Handle a single JSON-RPC message posted to /mcp."""
+    # The session_id query parameter (for SSE clients) is only logged, so
+    # only parse it when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        session_id = None
+        for part in scope.get("query_string", b"").split(b"&"):
+            if part.startswith(b"session_id="):
+                session_id = part[11:].decode()
+                break
+        logger.debug("POST with session_id: %s", session_id)
+
+    try:
+        # Read the POST body. JSON-RPC requests almost always arrive in a
+        # single message, so only fall back to buffering for multi-part bodies;
+        # orjson parses the bytearray without a final copy.
+        message = await receive()
+        full_body = message.get("body", b"")
+        if message.get("more_body", False):
+            buffer = bytearray(full_body)
+            while message.get("more_body", False):
+                message = await receive()
+                buffer += message.get("body", b"")
+            full_body = buffer
+        if message["type"] == "http.disconnect":
+            # Client went away before the body was complete; nobody to answer
+            logger.debug("Client disconnected before sending the request body")
+            return
+
+        request_data = orjson.loads(full_body)
+        if not isinstance(request_data, dict):
+            request_data = {}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "JSON-RPC request: method=%s id=%s (%d bytes)",
+                request_data.get("method"), request_data.get("id"), len(full_body),
+            )
+
+        # Handlers return the encoded response
+        method = request_data.get("method")
+        handler = _RPC_HANDLERS.get(method) if isinstance(method, str) else None
+        if not request_data:
+            response_body = _rpc_error(None, -32600, "Invalid request: expected a JSON-RPC object")
+        elif handler is None:
+            logger.warning("Unknown JSON-RPC method: %s", method)
+            response_body = _rpc_method_not_found(request_data)
+        else:
+            response_body = await handler(request_data)
+        logger.debug("Response: %d bytes: %.300r", len(response_body), response_body)
+
         await send({
             "type": "http.response.start",
             "status": 200,
-            "headers": [
-                [b"content-type", b"text/event-stream"],
-                [b"cache-control", b"no-cache"],
-                [b"connection", b"keep-alive"],
-            ],
+            "headers": [_CT_JSON, _cl(len(response_body)), _CORS_ALLOW_ORIGIN],
         })
-        logger.info(">>> SSE headers sent successfully")
 
-        # Send the endpoint event with session_id
-        endpoint_event = f"event: endpoint\ndata: /mcp?session_id={session_id}\n\n"
-        logger.info(f">>> Sending endpoint event: {endpoint_event.strip()}")
         await send({
             "type": "http.response.body",
-            "body": endpoint_event.encode(),
-            "more_body": True,
+            "body": response_body,
         })
-        logger.info(">>> Endpoint event sent successfully")
 
-        logger.info(f">>> SSE connection fully established with session {session_id}")
-        logger.info(f">>> Client should now POST to: /mcp?session_id={session_id}")
-
-        # Keep connection alive - wait for disconnect
-        try:
-            message_count = 0
-            while True:
-                message = await receive()
-                message_count += 1
-                logger.debug(f">>> SSE session {session_id}: received message #{message_count}: {message}")
-
-                if message["type"] == "http.disconnect":
-                    logger.info(f">>> Session {session_id} DISCONNECTED after {message_count} messages")
-                    break
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f">>> SSE connection error for session {session_id}: {e}", exc_info=True)
-
-    elif scope["method"] == "POST":
-        logger.info("<<< Handling POST request - direct message handling")
-
-        # Check for session_id in query string (for SSE clients)
-        query_string = scope.get("query_string", b"").decode()
-        session_id = None
-        if query_string:
-            from urllib.parse import parse_qs
-            params = parse_qs(query_string)
-            session_id = params.get("session_id", [None])[0]
-            logger.info(f"<<< POST with session_id: {session_id}")
-        else:
-            logger.info("<<< POST without session_id (direct client)")
+    except Exception as e:
+        logger.error("Error in POST handler: %s", e, exc_info=True)
+        error_response = {
+            "jsonrpc": "2.0",
+            "id": request_data.get("id") if 'request_data' in locals() else None,
+            "error": {
+                "code": -32603,
+                "message": str(e)
+            }
+        }
+        error_body = orjson.dumps(error_response)
 
         try:
-            # Read the POST body
-            logger.info("<<< Reading POST body...")
-            body_parts = []
-            chunk_count = 0
-            while True:
-                message = await receive()
-                chunk_count += 1
-                logger.debug(f"<<< Received chunk #{chunk_count}: {message}")
-
-                if message["type"] == "http.request":
-                    body_parts.append(message.get("body", b""))
-                    if not message.get("more_body", False):
-                        logger.info(f"<<< Body complete after {chunk_count} chunks")
-                        break
-
-            full_body = b"".join(body_parts)
-            logger.info(f"<<< Total body size: {len(full_body)} bytes")
-            logger.info(f"<<< Body preview: {full_body[:200]}")
-
-            request_data = json.loads(full_body)
-            logger.info(f"<<< Parsed JSON-RPC request:")
-            logger.info(f"<<<   Method: {request_data.get('method')}")
-            logger.info(f"<<<   ID: {request_data.get('id')}")
-            logger.info(f"<<<   Params: {request_data.get('params', {})}")
-
-            # Import needed for JSON-RPC handling
-            from mcp.types import JSONRPCRequest, JSONRPCResponse, JSONRPCError
-
-            # Handle the JSON-RPC request
-            logger.info(f"<<< Processing method: {request_data.get('method')}")
-
-            if request_data.get("method") == "initialize":
-                logger.info("<<< Handling 'initialize' request")
-                response = {
-                    "jsonrpc": "2.0",
-                    "id": request_data["id"],
-                    "result": {
-                        "protocolVersion": "2025-06-18",
-                        "capabilities": {
-                            "tools": {}
-                        },
-                        "serverInfo": {
-                            "name": "microsoft-graph-mcp",
-                            "version": "1.0.0"
-                        }
-                    }
-                }
-                logger.info("<<< Initialize response prepared")
-
-            elif request_data.get("method") == "tools/list":
-                logger.info("<<< Handling 'tools/list' request")
-                tools = await list_tools()
-                logger.info(f"<<< Found {len(tools)} tools")
-                response = {
-                    "jsonrpc": "2.0",
-                    "id": request_data["id"],
-                    "result": {
-                        "tools": [
-                            {
-                                "name": tool.name,
-                                "description": tool.description,
-                                "inputSchema": tool.inputSchema
-                            }
-                            for tool in tools
-                        ]
-                    }
-                }
-                logger.info(f"<<< Tools list response prepared with tools: {[t.name for t in tools]}")
-
-            elif request_data.get("method") == "tools/call":
-                tool_name = request_data["params"]["name"]
-                arguments = request_data["params"].get("arguments", {})
-                logger.info(f"<<< Handling 'tools/call' request for tool: {tool_name}")
-                logger.info(f"<<< Tool arguments: {arguments}")
-
-                result = await call_tool(tool_name, arguments)
-                logger.info(f"<<< Tool execution completed, result: {result}")
-
-                response = {
-                    "jsonrpc": "2.0",
-                    "id": request_data["id"],
-                    "result": {
-                        "content": [{"type": r.type, "text": r.text} for r in result]
-                    }
-                }
-                logger.info("<<< Tool call response prepared")
-
-            else:
-                logger.warning(f"<<< Unknown method: {request_data.get('method')}")
-                response = {
-                    "jsonrpc": "2.0",
-                    "id": request_data.get("id"),
-                    "error": {
-                        "code": -32601,
-                        "message": f"Method not found: {request_data.get('method')}"
-                    }
-                }
-
-            response_body = json.dumps(response).encode()
-            logger.info(f"<<< Response body size: {len(response_body)} bytes")
-            logger.info(f"<<< Response preview: {response_body[:300]}")
-
-            logger.info("<<< Sending HTTP 200 response...")
             await send({
                 "type": "http.response.start",
-                "status": 200,
-                "headers": [
-                    [b"content-type", b"application/json"],
-                    [b"content-length", str(len(response_body)).encode()],
-                ],
+                "status": 500,
+                "headers": [_CT_JSON, _cl(len(error_body)), _CORS_ALLOW_ORIGIN],
             })
-            logger.info("<<< Response headers sent")
-
             await send({
                 "type": "http.response.body",
-                "body": response_body,
+                "body": error_body,
             })
-            logger.info("<<< Response body sent - REQUEST COMPLETE")
-            logger.info("="*80)
-
-        except Exception as e:
-            logger.error("="*80)
-            logger.error(f"<<< ERROR in POST handler: {e}", exc_info=True)
-            logger.error("="*80)
-
-            error_response = {
-                "jsonrpc": "2.0",
-                "id": request_data.get("id") if 'request_data' in locals() else None,
-                "error": {
-                    "code": -32603,
-                    "message": str(e)
-                }
-            }
-            error_body = json.dumps(error_response).encode()
-            logger.error(f"<<< Sending error response: {error_body[:200]}")
+        except Exception as send_error:
+            logger.error("Failed to send error response: %s", send_error, exc_info=True)
 
-            try:
+
+# Methods served on /mcp; anything else is a 405
+_ROUTES = {
+    "GET": _handle_get,
+    "POST": _handle_post,
+}
+
+
+async def mcp_asgi_app(scope, receive, send):
+    """Raw ASGI application for handling MCP connections."""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] != "http":
+        logger.warning("Non-HTTP request type: %s", scope["type"])
+        return
+
+    # Only /mcp is served. Reject anything else (scanners, favicon fetches)
+    # before doing any other work for it.
+    if scope["path"] != "/mcp":
+        logger.debug("Path mismatch: %s != /mcp", scope["path"])
+        await send(_NOT_FOUND_START)
+        await send(_NOT_FOUND_BODY)
+        return
+
+    # Browsers send a preflight before every cross-origin POST; answer it
+    # before any logging or routing
+    if scope["method"] == "OPTIONS":
+        for name, value in scope.get("headers", ()):
+            if name == b"access-control-request-headers":
                 await send({
                     "type": "http.response.start",
-                    "status": 500,
-                    "headers": [[b"content-type", b"application/json"]],
-                })
-                await send({
-                    "type": "http.response.body",
-                    "body": error_body,
+                    "status": 204,
+                    "headers": _PREFLIGHT_BASE_HEADERS + [[b"access-control-allow-headers", value]],
                 })
-                logger.error("<<< Error response sent")
-            except Exception as send_error:
-                logger.error(f"<<< Failed to send error response: {send_error}", exc_info=True)
-    else:
-        logger.warning(f"Unsupported method: {scope['method']}")
-        await send({
-            "type": "http.response.start",
-            "status": 405,
-            "headers": [[b"content-type", b"text/plain"]],
-        })
-        await send({
-            "type": "http.response.body",
-            "body": b"Method Not Allowed",
-        })
+                break
+        else:
+            await send(_PREFLIGHT_START)
+        await send(_EMPTY_BODY)
+        return
 
-# Wrap with CORS middleware
-app = CORSMiddleware(
-    mcp_asgi_app,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Request: type=%s method=%s path=%s query=%s client=%s",
+            scope.get("type"), scope.get("method"), scope.get("path"),
+            scope.get("query_string", b""), scope.get("client"),
+        )
+        for key, value in scope.get("headers", []):
+            logger.debug("  %s: %s", key.decode(), value.decode())
+
+    handler = _ROUTES.get(scope["method"], _method_not_allowed)
+    await handler(scope, receive, send)
+
+
+app = mcp_asgi_app
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Each worker process imports this module itself, so the Graph client,
+    # connection pool and caches are created per worker. "auto" selects
+    # uvloop and httptools whenever they are installed.
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=port,
+        loop="auto",
+        http="auto",
+        # One worker by default: the user caches are per process, so with more
+        # workers a write only invalidates the cache of the worker serving it
+        workers=int(os.getenv("WORKERS") or os.getenv("WEB_CONCURRENCY", "1")),
+        log_level=os.getenv("LOG_LEVEL", "WARNING").lower(),
+        access_log=False,
+    )
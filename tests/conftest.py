@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+
+import httpx
+import pytest
+from azure.core.credentials import AccessToken
+from azure.identity.aio import ClientSecretCredential
+
+os.environ.setdefault("AZURE_TENANT_ID", "tenant")
+os.environ.setdefault("AZURE_CLIENT_ID", "client")
+os.environ.setdefault("AZURE_CLIENT_SECRET", "secret")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    """Route Graph traffic to a mock handler and start from empty caches.
+
+    Tests assign ``graph.handler`` a function taking an httpx.Request and
+    returning an httpx.Response. Token requests never reach Azure AD; each
+    one is recorded in ``graph.token_fetches``.
+    """
+    class Graph:
+        handler = staticmethod(lambda request: httpx.Response(404))
+        token_fetches = []
+
+    async def get_token(self, *scopes, **kwargs):
+        Graph.token_fetches.append((scopes, kwargs))
+        return AccessToken("token", int(time.time()) + 3600)
+
+    monkeypatch.setattr(ClientSecretCredential, "get_token", get_token)
+
+    transport = server.http_client._transport
+    while not isinstance(transport, server.AdmissionTransport):
+        transport = transport.transport
+    monkeypatch.setattr(transport, "_transport", httpx.MockTransport(lambda request: Graph.handler(request)))
+
+    server._user_cache.clear()
+    server._user_cache_index.clear()
+    server._user_list_cache.clear()
+    server.credential._cached_tokens.clear()
+    return Graph
@@ -0,0 +1,270 @@
+import asyncio
+import time
+
+import httpx
+
+import server
+
+
+def _run_startup():
+    """Drive the ASGI lifespan until startup completes."""
+    async def main():
+        inbox = asyncio.Queue()
+        sent = asyncio.Queue()
+        task = asyncio.create_task(server.lifespan(inbox.get, sent.put))
+        await inbox.put({"type": "lifespan.startup"})
+        assert (await sent.get())["type"] == "lifespan.startup.complete"
+        task.cancel()
+    asyncio.run(main())
+
+
+def test_startup_primes_the_token_used_by_graph_calls(graph):
+    graph.handler = lambda request: httpx.Response(
+        200, json={"id": "u1", "userPrincipalName": "a@example.com", "displayName": "A"}
+    )
+
+    _run_startup()
+    assert len(graph.token_fetches) == 1
+
+    result = asyncio.run(server.call_tool("read_user", {"userId": "u1"}))
+    assert '"id":"u1"' in result[0].text
+    assert len(graph.token_fetches) == 1
+
+
+def _post(body: bytes):
+    """POST a raw body to /mcp and return (status, decoded JSON body).
+
+    Every response must carry a content-length matching its body.
+    """
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/mcp", "query_string": b"", "headers": []}
+    asyncio.run(server.app(scope, receive, send))
+    payload = b"".join(m.get("body", b"") for m in messages[1:])
+    assert int(dict(messages[0]["headers"])[b"content-length"]) == len(payload)
+    return messages[0]["status"], server.orjson.loads(payload)
+
+
+def test_tools_call_without_id_or_params_returns_jsonrpc_error(graph):
+    status, response = _post(b'{"jsonrpc":"2.0","method":"tools/call","params":{"name":"read_user"}}')
+    assert status == 200
+    assert response["error"]["code"] == -32600
+
+    status, response = _post(b'{"jsonrpc":"2.0","id":3,"method":"tools/call","params":"read_user"}')
+    assert response == {"jsonrpc": "2.0", "id": 3, "error": response["error"]}
+    assert response["error"]["code"] == -32602
+
+
+def test_tools_call_failure_returns_jsonrpc_error(graph, monkeypatch):
+    async def broken(name, arguments):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server, "call_tool", broken)
+    status, response = _post(b'{"jsonrpc":"2.0","id":4,"method":"tools/call","params":{"name":"read_user"}}')
+    assert status == 200
+    assert response == {"jsonrpc": "2.0", "id": 4, "error": {"code": -32603, "message": "boom"}}
+
+
+def test_tools_call_result_has_content_length(graph):
+    graph.handler = lambda request: httpx.Response(200, json={"id": "u1", "userPrincipalName": "a@example.com"})
+    status, response = _post(
+        b'{"jsonrpc":"2.0","id":5,"method":"tools/call","params":{"name":"read_user","arguments":{"userId":"u1"}}}'
+    )
+    assert status == 200
+    assert response["id"] == 5
+    assert len(response["result"]["content"]) == 1
+    assert '"id":"u1"' in response["result"]["content"][0]["text"]
+
+
+def test_invalidation_drops_entries_cached_under_either_key(graph):
+    graph.handler = lambda request: httpx.Response(200, json={"id": "u1", "userPrincipalName": "a@example.com"})
+    asyncio.run(server.call_tool("read_user", {"userId": "a@example.com"}))
+    asyncio.run(server.call_tool("read_user", {"userId": "u1"}))
+    assert set(server._user_cache) == {"a@example.com", "u1"}
+
+    graph.handler = lambda request: httpx.Response(204)
+    asyncio.run(server.call_tool("delete_user", {"userId": "u1"}))
+    assert len(server._user_cache) == 0
+
+
+def test_batch_users_rejects_update_fields_it_cannot_apply(graph):
+    result = asyncio.run(server.call_tool("batch_users", {
+        "operations": [{"op": "update", "userId": "u1", "body": {"mobilePhone": "555"}}],
+    }))
+    assert result[0].text.startswith("Error: Invalid arguments for batch_users")
+
+
+def test_bulk_reports_failures_with_non_dict_bodies(graph):
+    def handler(request):
+        requests = server.orjson.loads(request.content)["requests"]
+        # A null success body, a base64 error body and a regular error body
+        bodies = [None, "PGh0bWw+PC9odG1sPg==", {"error": {"message": "nope"}}]
+        return httpx.Response(200, json={"responses": [
+            {"id": sub["id"], "status": 204 if sub["id"] == "0" else 500, "body": body}
+            for sub, body in zip(requests, bodies)
+        ]})
+
+    graph.handler = handler
+    result = asyncio.run(server.call_tool("bulk_delete_users", {"userIds": ["a", "b", "c"]}))
+    summary, detail = result[0].text.split("\n", 1)
+    assert summary == "Batch completed: 1/3 succeeded"
+    assert server.orjson.loads(detail) == [
+        {"user": "a", "status": 204},
+        {"user": "b", "status": 500, "error": "Request failed with status 500"},
+        {"user": "c", "status": 500, "error": "nope"},
+    ]
+
+
+def _preflight(headers):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "OPTIONS", "path": "/mcp", "query_string": b"", "headers": headers}
+    asyncio.run(server.app(scope, receive, send))
+    return messages[0]["status"], dict(messages[0]["headers"])
+
+
+def test_preflight_echoes_requested_headers():
+    status, headers = _preflight([
+        (b"origin", b"https://app.example.com"),
+        (b"access-control-request-method", b"POST"),
+        (b"access-control-request-headers", b"authorization,content-type"),
+    ])
+    assert status == 204
+    assert headers[b"access-control-allow-headers"] == b"authorization,content-type"
+
+    status, headers = _preflight([(b"access-control-request-method", b"POST")])
+    assert headers[b"access-control-allow-headers"] == b"*"
+
+
+def test_bulk_escapes_slashes_in_user_ids(graph):
+    sent = []
+
+    def handler(request):
+        requests = server.orjson.loads(request.content)["requests"]
+        sent.extend(sub["url"] for sub in requests)
+        return httpx.Response(200, json={"responses": [{"id": sub["id"], "status": 204} for sub in requests]})
+
+    graph.handler = handler
+    asyncio.run(server.call_tool("bulk_delete_users", {"userIds": ["../groups/g1", "x/manager/$ref"]}))
+    assert sent == ["/users/..%2Fgroups%2Fg1", "/users/x%2Fmanager%2F%24ref"]
+
+
+def test_claims_challenge_replaces_the_cached_token(graph):
+    scope = server.GRAPH_SCOPE
+
+    async def main():
+        first = await server.credential.get_token(scope, enable_cae=True)
+        challenged = await server.credential.get_token(scope, claims="{}", enable_cae=True)
+        after = await server.credential.get_token(scope, enable_cae=True)
+        return first, challenged, after
+
+    first, challenged, after = asyncio.run(main())
+    assert len(graph.token_fetches) == 2
+    assert after is challenged
+    assert after is not first
+
+
+def test_updates_without_fields_are_rejected(graph):
+    result = asyncio.run(server.call_tool("batch_users", {
+        "operations": [{"op": "update", "userId": "u1", "body": {}}],
+    }))
+    assert result[0].text.startswith("Error: Invalid arguments for batch_users")
+
+    result = asyncio.run(server.call_tool("bulk_update_users", {"users": [{"userId": "u1"}]}))
+    assert result[0].text.startswith("Error: Invalid arguments for bulk_update_users")
+
+
+def _throttled(retry_after="0.2"):
+    return httpx.Response(429, headers={"Retry-After": retry_after})
+
+
+def test_admission_halves_once_per_throttling_burst_and_holds_new_requests():
+    async def main():
+        controller = server.AdmissionController(16)
+        for _ in range(16):
+            await controller.acquire()
+        for _ in range(16):
+            await controller.release(_throttled())
+        assert controller.limit == 8
+        assert controller.active == 0
+
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        await asyncio.wait_for(waiter, 1)
+        assert controller.active == 1
+        assert time.monotonic() >= controller.backoff_until
+    asyncio.run(main())
+
+
+def test_admission_recovers_to_max_limit_after_the_window():
+    async def main():
+        controller = server.AdmissionController(4)
+        await controller.acquire()
+        await controller.release(_throttled("0.1"))
+        assert controller.limit == 2
+
+        for _ in range(10):
+            await controller.acquire()
+            await controller.release(httpx.Response(200))
+        assert controller.limit == 4
+    asyncio.run(main())
+
+
+def test_list_users_follows_next_link_with_count_headers(graph):
+    next_link = "https://graph.microsoft.com/v1.0/users?$skiptoken=page2"
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        if "$skiptoken" in str(request.url):
+            users = [{"id": f"u{i}"} for i in range(999, 1004)]
+            return httpx.Response(200, json={"value": users})
+        users = [{"id": f"u{i}"} for i in range(999)]
+        return httpx.Response(200, json={"@odata.count": 1234, "@odata.nextLink": next_link, "value": users})
+
+    graph.handler = handler
+    result = asyncio.run(server.call_tool("list_users", {"top": 1001, "count": True}))
+    response = server.orjson.loads(result[0].text)
+    assert response["count"] == 1001
+    assert response["total"] == 1234
+    assert response["users"][-1]["id"] == "u1000"
+
+    assert len(sent) == 2
+    first = sent[0].url.params
+    assert first["$top"] == "999"
+    assert first["$count"] == "true"
+    assert first["$select"] == ",".join(server._USER_LIST_FIELDS)
+    assert str(sent[1].url) == next_link
+    assert all(request.headers["ConsistencyLevel"] == "eventual" for request in sent)
+
+
+def test_batch_resends_throttled_sub_requests(graph):
+    sent = []
+
+    def handler(request):
+        requests = server.orjson.loads(request.content)["requests"]
+        sent.append([sub["id"] for sub in requests])
+        if len(sent) == 1:
+            return httpx.Response(200, json={"responses": [
+                {"id": "0", "status": 204},
+                {"id": "1", "status": 429, "headers": {"Retry-After": "0"}},
+            ]})
+        return httpx.Response(200, json={"responses": [{"id": sub["id"], "status": 204} for sub in requests]})
+
+    graph.handler = handler
+    result = asyncio.run(server.call_tool("bulk_delete_users", {"userIds": ["a", "b"]}))
+    assert result[0].text.split("\n", 1)[0] == "Batch completed: 2/2 succeeded"
+    assert sent == [["0", "1"], ["1"]]